@@ -11,26 +11,98 @@ import sys
 import argparse
 import asyncio
 import hashlib
-import json
+import logging
+import logging.handlers
+import queue
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 from dotenv import load_dotenv
 load_dotenv()
 
+from collections import deque
+
+import aiohttp
+import zstandard as zstd
+
 import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from playwright.async_api import async_playwright, TimeoutError as PWTimeout
 
 from db_manager import URL, Snapshot, CrawlRun, Link, Base
 
+# URLs claimed per worker round-trip; amortizes the claim
+# SELECT + UPDATE + COMMIT over several jobs
+CLAIM_BATCH = 8
+
+# Shared url -> id cache so repeat hrefs skip the resolving SELECT;
+# bounded with FIFO eviction, guarded by url_id_cache_lock
+URL_ID_CACHE_MAX = 200_000
+url_id_cache = {}
+url_id_cache_lock = asyncio.Lock()
+
+def _cache_url_ids(pairs):
+    """Store (url, id) pairs, FIFO-evicting beyond the cap. Caller holds
+    url_id_cache_lock."""
+    for u, i in pairs:
+        if u not in url_id_cache and len(url_id_cache) >= URL_ID_CACHE_MAX:
+            url_id_cache.pop(next(iter(url_id_cache)))
+        url_id_cache[u] = i
+
 USER_AGENTS = {
     'desktop': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
     'mobile':  'Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X)',
     'bot':     'Googlebot/2.1 (+http://www.google.com/bot.html)'
 }
 
+log = logging.getLogger('crawler')
+
+def _setup_logging():
+    """Route log records through a queue to a background thread so workers
+    never serialize on stdout; returns the listener to stop at shutdown."""
+    q = queue.Queue(-1)
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.handlers.QueueHandler(q))
+    listener = logging.handlers.QueueListener(q, logging.StreamHandler())
+    listener.start()
+    return listener
+
+def _host(u: str):
+    """Netloc of an http(s) URL without urlparse's ParseResult machinery;
+    ~10x cheaper per call. Returns None for any other scheme."""
+    if u.startswith('https://'):
+        i = 8
+    elif u.startswith('http://'):
+        i = 7
+    else:
+        return None
+    e = len(u)
+    for sep in ('/', '?', '#'):
+        j = u.find(sep, i)
+        if j != -1 and j < e:
+            e = j
+    return u[i:e]
+
+def _hash_bytes(data: bytes) -> str:
+    """SHA-256 over a buffer in 64 KB chunks.
+
+    Runs in a thread via asyncio.to_thread: hashlib releases the GIL for
+    large buffers, so other workers keep servicing I/O during the hash.
+    """
+    h = hashlib.sha256()
+    mv = memoryview(data)
+    for i in range(0, len(mv), 65536):
+        h.update(mv[i:i + 65536])
+    return h.hexdigest()
+
+def _hash_encode(text: str) -> "tuple[bytes, str]":
+    """Encode page text once and hash it; thread-offloaded like _hash_bytes."""
+    data = text.encode('utf-8', 'replace')
+    return data, _hash_bytes(data)
+
 async def wait_for_full_load(page, timeout=15000):
     try:    await page.wait_for_load_state('load', timeout=timeout)
     except PWTimeout: pass
@@ -45,7 +117,7 @@ async def crawl(start_url: str, mode: str, concurrency: int, Session):
         session.add(run)
         await session.commit()
         run_id = run.id
-    print(f"ðŸš€ Starting crawl run {run_id} (mode={mode}) at {datetime.now(timezone.utc)} UTC")
+    log.info(f"ðŸš€ Starting crawl run {run_id} (mode={mode}) at {datetime.now(timezone.utc)} UTC")
 
     base_host = urlparse(start_url).netloc
 
@@ -55,150 +127,398 @@ async def crawl(start_url: str, mode: str, concurrency: int, Session):
         if existing:
             existing.status = 'pending'
             existing.last_attempt = None
+            seed = existing
         else:
-            session.add(URL(url=start_url, category='internal', status='pending'))
+            seed = URL(url=start_url, category='internal', status='pending')
+            session.add(seed)
         await session.commit()
+        async with url_id_cache_lock:
+            _cache_url_ids([(start_url, seed.id)])
+
+    # Lightweight HTTP pool for external status checks; Chromium's full
+    # network stack is overkill when only the status code matters
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency * 4, ttl_dns_cache=300),
+        headers={'User-Agent': USER_AGENTS[mode]}
+    )
+
+    # Newly discovered URLs funnel through one queue so bursty pages are
+    # flushed in cross-worker batches instead of per-page inserts
+    url_queue = asyncio.Queue()
+
+    async def url_ingestor():
+        loop = asyncio.get_running_loop()
+        while True:
+            # Block for the first row, then fill the batch for up to
+            # 200 ms or 500 rows, whichever comes first
+            batch = [await url_queue.get()]
+            deadline = loop.time() + 0.2
+            while len(batch) < 500:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(url_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Two workers can discover the same URL in one window
+            rows = list({r['url']: r for r in batch}.values())
+            try:
+                for attempt in range(5):
+                    try:
+                        async with Session() as s:
+                            await s.execute(
+                                mysql_insert(URL).values(rows).prefix_with('IGNORE')
+                            )
+                            await s.commit()
+                        break
+                    except Exception as e:
+                        log.error(f"[Ingestor] Flush attempt {attempt + 1} "
+                                  f"for {len(rows)} URLs failed: {e}")
+                        await asyncio.sleep(0.5 * (attempt + 1))
+                else:
+                    # Never drop discovered URLs: put them back for a later
+                    # flush. join() stays held until they actually land, so
+                    # waiting workers still resolve correct ids.
+                    for r in rows:
+                        url_queue.put_nowait(r)
+            finally:
+                # Release the original batch's joiners in every outcome
+                for _ in batch:
+                    url_queue.task_done()
 
     async with async_playwright() as pw:
         browser = await pw.chromium.launch(headless=True)
-        context = await browser.new_context(user_agent=USER_AGENTS[mode])
+        # One context per worker: each gets its own CDP session and network
+        # stack, so one worker's large download doesn't head-of-line block
+        # the rest on a shared WebSocket
+        contexts = [
+            await browser.new_context(user_agent=USER_AGENTS[mode])
+            for _ in range(concurrency)
+        ]
 
         from playwright._impl._errors import TargetClosedError
 
-        async def worker(idx: int):
+        async def worker(idx: int, context):
             async with Session() as session:
+                claimed = deque()
+                page = None  # one reusable page per worker
                 while True:
-                    # Claim one pending URL atomically
-                    res = await session.execute(
-                        sa.select(URL)
-                          .where(URL.status == 'pending')
-                          .order_by(URL.id)
-                          .with_for_update(skip_locked=True)
-                          .limit(1)
-                    )
-                    url_obj = res.scalars().first()
-                    if not url_obj:
-                        return  # no more work
-
-                    # Classify and mark in_progress
-                    parsed = urlparse(url_obj.url)
-                    url_obj.category = 'internal' if parsed.netloc == base_host else 'external'
-                    url_obj.status = 'in_progress'
-                    url_obj.last_attempt = datetime.now(timezone.utc)
-                    await session.commit()
-
-                    print(f"[Worker {idx}] Crawling: {url_obj.url} ({url_obj.category})")
-
-                    if url_obj.category == 'external':
-                        # Only fetch HTTP status
-                        try:
-                            resp = await context.request.get(url_obj.url, timeout=30000)
-                            status = resp.status
-                            err = None
-                        except Exception as e:
-                            status = None
-                            err = str(e)
-                        snap = Snapshot(
-                            url_id=url_obj.id,
-                            run_id=run_id,
-                            mode=mode,
-                            status_code=status,
-                            error_message=err,
-                            timestamp=datetime.now(timezone.utc)
-                        )
-                        session.add(snap)
-                        url_obj.status = 'done'
-                        await session.commit()
-                        print(f"[Worker {idx}] External URL status: {status}")
-                        continue
-
-                    # Internal page: full rendering
+                    url = None
                     try:
-                        page = await context.new_page()
-                    except TargetClosedError:
-                        # Browser or context already closed; exit worker
-                        return
+                        if not claimed:
+                            # Claim a batch of pending URLs atomically:
+                            # lock up to CLAIM_BATCH rows, mark them all
+                            # in_progress with one UPDATE, commit once.
+                            # Plain (id, url) tuples, not ORM instances: a
+                            # later rollback expires every object in the
+                            # session, and reading an expired attribute
+                            # lazy-loads synchronously, which AsyncSession
+                            # rejects with MissingGreenlet
+                            res = await session.execute(
+                                sa.select(URL.id, URL.url)
+                                  .where(URL.status == 'pending')
+                                  .order_by(URL.id)
+                                  .with_for_update(skip_locked=True)
+                                  .limit(CLAIM_BATCH)
+                            )
+                            batch = res.all()
+                            if not batch:
+                                if page is not None and not page.is_closed():
+                                    await page.close()
+                                return  # no more work
+                            await session.execute(
+                                sa.update(URL)
+                                  .where(URL.id.in_([i for i, _ in batch]))
+                                  .values(status='in_progress',
+                                          last_attempt=datetime.now(timezone.utc))
+                                  .execution_options(synchronize_session=False)
+                            )
+                            await session.commit()
+                            claimed.extend(batch)
 
-                    try:
-                        resp = await page.goto(url_obj.url, timeout=30000, wait_until='domcontentloaded')
-                        status_code = resp.status if resp else None
-                        await wait_for_full_load(page)
-
-                        # Performance metrics
-                        timing = await page.evaluate("() => JSON.stringify(window.performance.timing)")
-                        perf = json.loads(timing)
-                        nav = perf.get('navigationStart', 0)
-                        ttfb = perf.get('responseStart', 0) - nav
-                        domc = perf.get('domContentLoadedEventEnd', 0) - nav
-                        loade = perf.get('loadEventEnd', 0) - nav
-
-                        # Discover outgoing links
-                        hrefs = await page.eval_on_selector_all('a[href]', 'els => els.map(e => e.href)')
-                        new_links = []
-                        for href in set(hrefs):
-                            if href == url_obj.url:
-                                continue
-                            p = urlparse(href)
-                            if p.scheme in ('http', 'https'):
-                                target = await session.scalar(sa.select(URL).filter_by(url=href))
-                                if not target:
-                                    cat = 'internal' if p.netloc == base_host else 'external'
-                                    new_url = URL(url=href, category=cat, status='pending')
-                                    session.add(new_url)
-                                    await session.commit()
-                                    tgt_id = new_url.id
-                                else:
-                                    tgt_id = target.id
-                                new_links.append((url_obj.id, tgt_id))
-                        print(f"[Worker {idx}] Detected {len(new_links)} outgoing links")
-
-                        # Snapshot content
-                        content = await page.content()
-                        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
-                        snap = Snapshot(
-                            url_id=url_obj.id,
-                            run_id=run_id,
-                            mode=mode,
-                            status_code=status_code,
-                            content_hash=digest,
-                            content=content,
-                            ttfb_ms=ttfb,
-                            dom_content_loaded_ms=domc,
-                            load_event_end_ms=loade,
-                            timestamp=datetime.now(timezone.utc)
-                        )
-                        session.add(snap)
-                        await session.flush()  # assign snap.id
-
-                        # Persist link graph edges
-                        for src, tgt in new_links:
-                            session.add(Link(source_id=src, target_id=tgt, snapshot_id=snap.id))
-
-                        url_obj.status = 'done'
-                        await session.commit()
+                        url_id, url = claimed.popleft()
 
-                    except Exception as e:
+                        # Classify; the claim already marked it in_progress.
+                        # The category rides along with the per-URL closing
+                        # UPDATE, so each URL still costs one fsync.
+                        category = 'internal' if _host(url) == base_host else 'external'
+
+                        log.info(f"[Worker {idx}] Crawling: {url} ({category})")
+
+                        if category == 'external':
+                            # Only fetch HTTP status: a pooled HEAD, with a
+                            # zero-byte ranged GET for servers that reject HEAD
+                            try:
+                                async with http_session.head(
+                                    url, allow_redirects=True,
+                                    timeout=aiohttp.ClientTimeout(total=30)
+                                ) as resp:
+                                    status = resp.status
+                                if status in (405, 501):
+                                    async with http_session.get(
+                                        url, allow_redirects=True,
+                                        headers={'Range': 'bytes=0-0'},
+                                        timeout=aiohttp.ClientTimeout(total=30)
+                                    ) as resp:
+                                        status = resp.status
+                                err = None
+                            except Exception as e:
+                                status = None
+                                err = str(e)
+                            snap = Snapshot(
+                                url_id=url_id,
+                                run_id=run_id,
+                                mode=mode,
+                                status_code=status,
+                                error_message=err,
+                                timestamp=datetime.now(timezone.utc)
+                            )
+                            session.add(snap)
+                            await session.execute(
+                                sa.update(URL)
+                                  .where(URL.id == url_id)
+                                  .values(status='done', category=category)
+                            )
+                            await session.commit()
+                            log.info(f"[Worker {idx}] External URL status: {status}")
+                            continue
+
+                        # Internal page: full rendering. Reuse the worker's page
+                        # across URLs; Page.navigate is far cheaper than tearing
+                        # down and creating a renderer target every time
+                        if page is None or page.is_closed():
+                            try:
+                                page = await context.new_page()
+                            except TargetClosedError:
+                                # Browser or context already closed; exit worker
+                                return
+
+                        try:
+                            resp = await page.goto(url, timeout=30000, wait_until='domcontentloaded')
+                            status_code = resp.status if resp else None
+                            await wait_for_full_load(page)
+
+                            # Performance metrics: derive the three values
+                            # in-page so only [ttfb, domc, loade] crosses CDP
+                            ttfb, domc, loade = await page.evaluate(
+                                """() => {
+                                    const nav = performance.getEntriesByType('navigation')[0];
+                                    if (nav) {
+                                        return [nav.responseStart | 0,
+                                                nav.domContentLoadedEventEnd | 0,
+                                                nav.loadEventEnd | 0];
+                                    }
+                                    const t = performance.timing, n = t.navigationStart;
+                                    return [t.responseStart - n,
+                                            t.domContentLoadedEventEnd - n,
+                                            t.loadEventEnd - n];
+                                }"""
+                            )
+
+                            # Discover outgoing links: dedupe, scheme-filter and
+                            # drop self-links in the browser so only the final
+                            # list crosses the CDP boundary
+                            hrefs = await page.evaluate(
+                                """(selfUrl) => {
+                                    const out = new Set();
+                                    for (const a of document.querySelectorAll('a[href]')) {
+                                        const h = a.href;
+                                        if (!h || h === selfUrl) continue;
+                                        if (!h.startsWith('http://') && !h.startsWith('https://')) continue;
+                                        out.add(h);
+                                    }
+                                    return [...out];
+                                }""",
+                                url
+                            )
+                            url_rows = [{
+                                'url': href,
+                                'category': 'internal' if _host(href) == base_host else 'external',
+                                'status': 'pending'
+                            } for href in hrefs]
+                            # Cache hits need no DB trip at all; only misses go
+                            # through the batched INSERT IGNORE + resolving SELECT
+                            target_ids = []
+                            misses = []
+                            async with url_id_cache_lock:
+                                for r in url_rows:
+                                    cached = url_id_cache.get(r['url'])
+                                    if cached is not None:
+                                        target_ids.append(cached)
+                                    else:
+                                        misses.append(r)
+                            if misses:
+                                # Resolve already-known URLs with one IN select,
+                                # insert only the genuinely new ones, then fetch
+                                # just their ids: ~3 round-trips per page
+                                res = await session.execute(
+                                    sa.select(URL.url, URL.id).where(
+                                        URL.url.in_([r['url'] for r in misses])
+                                    )
+                                )
+                                resolved = res.all()
+                                known = {u for u, _ in resolved}
+                                new_rows = [r for r in misses if r['url'] not in known]
+                                if new_rows:
+                                    # Hand new URLs to the shared ingestor and
+                                    # wait for its flush before resolving ids
+                                    for r in new_rows:
+                                        url_queue.put_nowait(r)
+                                    await url_queue.join()
+                                    res = await session.execute(
+                                        sa.select(URL.url, URL.id).where(
+                                            URL.url.in_([r['url'] for r in new_rows])
+                                        )
+                                    )
+                                    resolved += res.all()
+                                target_ids.extend(i for _, i in resolved)
+                                async with url_id_cache_lock:
+                                    _cache_url_ids(resolved)
+                            log.info(f"[Worker {idx}] Detected {len(target_ids)} outgoing links")
+
+                            # Snapshot content: prefer the raw main-document
+                            # body, which arrives as bytes over CDP without
+                            # serializing the DOM or re-encoding; fall back to
+                            # the rendered DOM when the body is unavailable
+                            # (SPA shells, cache hits, redirect chains)
+                            content_bytes = None
+                            if resp is not None:
+                                try:
+                                    content_bytes = await resp.body()
+                                except Exception:
+                                    content_bytes = None
+                            if content_bytes:
+                                digest = await asyncio.to_thread(_hash_bytes, content_bytes)
+                            else:
+                                content_bytes, digest = await asyncio.to_thread(
+                                    _hash_encode, await page.content()
+                                )
+
+                            # If this exact body is already stored for this URL,
+                            # reference the original instead of rewriting it.
+                            # Only rows that hold the body qualify, so dedup_of
+                            # never points at another dedup row
+                            prior = await session.scalar(
+                                sa.select(Snapshot.id)
+                                  .where(Snapshot.url_id == url_id,
+                                         Snapshot.content_hash == digest,
+                                         Snapshot.content.isnot(None))
+                                  .limit(1)
+                            )
+                            # Compress novel bodies before they hit the wire;
+                            # HTML shrinks 5-10x under zstd level 3. The hash
+                            # stays over the raw bytes so dedup still matches.
+                            if prior:
+                                stored = None
+                            else:
+                                stored = await asyncio.to_thread(
+                                    zstd.compress, content_bytes, 3
+                                )
+
+                            # Core insert: the big content row skips the ORM
+                            # unit-of-work (identity map, per-row events)
+                            res = await session.execute(
+                                sa.insert(Snapshot).values(
+                                    url_id=url_id,
+                                    run_id=run_id,
+                                    mode=mode,
+                                    status_code=status_code,
+                                    content_hash=digest,
+                                    content=stored,
+                                    content_encoding=None if stored is None else 'zstd',
+                                    dedup_of=prior,
+                                    ttfb_ms=ttfb,
+                                    dom_content_loaded_ms=domc,
+                                    load_event_end_ms=loade,
+                                    timestamp=datetime.now(timezone.utc)
+                                )
+                            )
+                            snap_id = res.inserted_primary_key[0]
+
+                            # Persist link graph edges in one bulk insert.
+                            # FK probes are skipped for just this statement:
+                            # target ids come from a SELECT issued after the
+                            # ingestor's flush (workers wait on join() first)
+                            # and snap_id was inserted in this transaction,
+                            # so the referenced rows exist. The SET pair runs
+                            # on the transaction's pinned connection and the
+                            # default is restored before it returns to the
+                            # pool; links has no unique secondary index, so
+                            # unique_checks stays at its default.
+                            if target_ids:
+                                await session.execute(
+                                    sa.text("SET foreign_key_checks=0")
+                                )
+                                try:
+                                    await session.execute(
+                                        sa.insert(Link),
+                                        [{'source_id': url_id, 'target_id': tgt, 'snapshot_id': snap_id}
+                                         for tgt in target_ids]
+                                    )
+                                finally:
+                                    await session.execute(
+                                        sa.text("SET foreign_key_checks=1")
+                                    )
+
+                            await session.execute(
+                                sa.update(URL)
+                                  .where(URL.id == url_id)
+                                  .values(status='done', category=category)
+                            )
+                            await session.commit()
+
+                        except OperationalError:
+                            raise  # handled by the per-iteration handler below
+                        except Exception as e:
+                            await session.rollback()
+                            error_snap = Snapshot(
+                                url_id=url_id,
+                                run_id=run_id,
+                                mode=mode,
+                                status_code=None,
+                                error_message=str(e),
+                                timestamp=datetime.now(timezone.utc)
+                            )
+                            session.add(error_snap)
+                            await session.execute(
+                                sa.update(URL)
+                                  .where(URL.id == url_id)
+                                  .values(status='error', category=category)
+                            )
+                            await session.commit()
+                            log.error(f"[Worker {idx}] Error on {url}: {e}")
+                            # Discard the page so the next URL starts clean
+                            try:
+                                await page.close()
+                            except Exception:
+                                pass
+                            page = None
+                    except OperationalError as e:
+                        # Transient DB error anywhere in the iteration
+                        # (claim included): roll back and keep the pooled
+                        # session (pre-ping revalidates the connection)
                         await session.rollback()
-                        error_snap = Snapshot(
-                            url_id=url_obj.id,
-                            run_id=run_id,
-                            mode=mode,
-                            status_code=None,
-                            error_message=str(e),
-                            timestamp=datetime.now(timezone.utc)
-                        )
-                        session.add(error_snap)
-                        url_obj.status = 'error'
-                        await session.commit()
-                        print(f"[Worker {idx}] Error on {url_obj.url}: {e}", file=sys.stderr)
-                    finally:
-                        await page.close()
-
-        # Launch and await workers, then close the browser
-        tasks = [asyncio.create_task(worker(i)) for i in range(concurrency)]
-        await asyncio.gather(*tasks, return_exceptions=True)
+                        log.error(f"[Worker {idx}] DB error on {url or 'claim'}: {e}")
+
+        # Launch the ingestor and workers, then close contexts and browser
+        ingest_task = asyncio.create_task(url_ingestor())
+        tasks = [asyncio.create_task(worker(i, contexts[i])) for i in range(concurrency)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for i, result in enumerate(results):
+            if result is not None:
+                log.error(f"[Worker {i}] Died with unhandled error: {result!r}")
+        ingest_task.cancel()
+        try:
+            await ingest_task
+        except asyncio.CancelledError:
+            pass
+        for ctx in contexts:
+            await ctx.close()
         await browser.close()
 
+    await http_session.close()
+
     # Mark crawl run end
     async with Session() as session:
         await session.execute(
@@ -207,7 +527,7 @@ async def crawl(start_url: str, mode: str, concurrency: int, Session):
               .values(end_time=datetime.now(timezone.utc))
         )
         await session.commit()
-    print(f"ðŸ Finished crawl run {run_id} at {datetime.now(timezone.utc)} UTC")
+    log.info(f"ðŸ Finished crawl run {run_id} at {datetime.now(timezone.utc)} UTC")
 
 
 def get_database_url():
@@ -232,11 +552,25 @@ async def main():
     if args.command == 'crawl':
         if not args.start_url:
             parser.error('start_url is required')
-        engine = create_async_engine(get_database_url(), echo=False)
+        # One connection per worker plus one for the URL ingestor.
+        # READ COMMITTED is applied at the engine level so every pooled
+        # (and recycled) connection gets it: claims must see URLs other
+        # workers just committed, and the post-flush id re-SELECT must see
+        # the ingestor's rows even when its transaction began earlier.
+        engine = create_async_engine(
+            get_database_url(), echo=False,
+            isolation_level="READ COMMITTED",
+            pool_size=args.concurrency + 1, max_overflow=0,
+            pool_pre_ping=True, pool_recycle=1800
+        )
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
         Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
-        await crawl(args.start_url, args.mode, args.concurrency, Session)
+        listener = _setup_logging()
+        try:
+            await crawl(args.start_url, args.mode, args.concurrency, Session)
+        finally:
+            listener.stop()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -18,7 +18,7 @@ load_dotenv()
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.dialects.mysql import LONGBLOB
 
 # ORM Base and Models
 Base = declarative_base()
@@ -48,6 +48,9 @@ class URL(Base):
 
     __table_args__ = (
         sa.Index('uq_urls_url', 'url', unique=True, mysql_length=191),
+        # Covering index so the pending-claim query jumps straight to the
+        # head of the queue instead of scanning done rows by PK
+        sa.Index('ix_urls_status_id', 'status', 'id'),
     )
 
 class CrawlRun(Base):
@@ -73,7 +76,9 @@ class Snapshot(Base):
     )
     status_code           = sa.Column(sa.Integer, nullable=True)
     content_hash          = sa.Column(sa.String(64), nullable=True)
-    content               = sa.Column(LONGTEXT, nullable=True)
+    content               = sa.Column(LONGBLOB, nullable=True)
+    content_encoding      = sa.Column(sa.String(8), nullable=True)  # 'zstd' when compressed
+    dedup_of              = sa.Column(sa.Integer, sa.ForeignKey('snapshots.id'), nullable=True)
     error_message         = sa.Column(sa.Text, nullable=True)
     ttfb_ms               = sa.Column(sa.Integer, nullable=True)
     dom_content_loaded_ms = sa.Column(sa.Integer, nullable=True)
@@ -83,6 +88,10 @@ class Snapshot(Base):
     url = relationship("URL", back_populates="snapshots")
     run = relationship("CrawlRun", back_populates="snapshots")
 
+    __table_args__ = (
+        sa.Index('ix_snap_url_hash', 'url_id', 'content_hash'),
+    )
+
 class Link(Base):
     __tablename__ = 'links'
     id          = sa.Column(sa.Integer, primary_key=True)
@@ -94,6 +103,11 @@ class Link(Base):
     target   = relationship("URL", foreign_keys=[target_id], back_populates="incoming")
     snapshot = relationship("Snapshot")
 
+    __table_args__ = (
+        sa.Index('ix_links_src', 'source_id'),
+        sa.Index('ix_links_tgt', 'target_id'),
+    )
+
 # Utilities
 def get_database_url():
     url = os.getenv('DATABASE_URL')
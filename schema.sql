@@ -11,7 +11,8 @@ CREATE TABLE urls (
   category      VARCHAR(16) NOT NULL,
   status        ENUM('pending','in_progress','done','error') NOT NULL DEFAULT 'pending',
   last_attempt  DATETIME NULL,
-  UNIQUE KEY uq_urls_url (url(191))
+  UNIQUE KEY uq_urls_url (url(191)),
+  KEY ix_urls_status_id (status, id)
 );
 
 CREATE TABLE crawl_runs (
@@ -28,14 +29,18 @@ CREATE TABLE snapshots (
   mode                      ENUM('desktop','mobile','bot') NOT NULL,
   status_code               INT NULL,
   content_hash              CHAR(64) NULL,
-  content                   LONGTEXT NULL,
+  content                   LONGBLOB NULL,
+  content_encoding          VARCHAR(8) NULL,
+  dedup_of                  INT NULL,
   error_message             TEXT NULL,
   ttfb_ms                   INT NULL,
   dom_content_loaded_ms     INT NULL,
   load_event_end_ms         INT NULL,
   timestamp                 DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  KEY ix_snap_url_hash (url_id, content_hash),
   FOREIGN KEY (url_id) REFERENCES urls(id) ON DELETE CASCADE,
-  FOREIGN KEY (run_id) REFERENCES crawl_runs(id) ON DELETE CASCADE
+  FOREIGN KEY (run_id) REFERENCES crawl_runs(id) ON DELETE CASCADE,
+  FOREIGN KEY (dedup_of) REFERENCES snapshots(id)
 );
 
 CREATE TABLE links (
@@ -43,6 +48,8 @@ CREATE TABLE links (
   source_id      INT NOT NULL,
   target_id      INT NOT NULL,
   snapshot_id    INT NOT NULL,
+  KEY ix_links_src (source_id),
+  KEY ix_links_tgt (target_id),
   FOREIGN KEY (source_id)   REFERENCES urls(id)      ON DELETE CASCADE,
   FOREIGN KEY (target_id)   REFERENCES urls(id)      ON DELETE CASCADE,
   FOREIGN KEY (snapshot_id) REFERENCES snapshots(id) ON DELETE CASCADE